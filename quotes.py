@@ -7,6 +7,9 @@
 #
 # <https://github.com/sourcejedi/quotes.py>
 
+# It can also be imported, to check documents from other code.
+# See main() for how the checkers are used.
+
 # This script was originally developed using python3;
 # it should convert back very nicely using 2to3
 # (for best results, remove all use of unicode() and (object) first :).
@@ -17,26 +20,20 @@ import glob
 import optparse
 import io
 import htmlentitydefs
+import threading
+import Queue
+import json
+import zlib
+import bisect
 
 # TODO list:
 #
 # docs
-# automated tests?
-#
-# Ideally, we should be able to turn off checking brackets, in case of false positives.
 #
 # We're silently clobbering files with a .tmp extension
 
-# --strict-british
-# --strict-american
-# (like samequotes, but with a set starting quote type)
-
 # NOT IMPLEMENTED:
 #  Character encoding must be specified manually (if not UTF-8).
-#  <q> tags will be ignored
-#  <pre> will be treated as one big paragraph
-#  <br> - even multiple successive line breaks 
-#         will not be treated as a paragraph break
 #
 # We don't have any progress indicator, and we can take e.g. 30s to run on my EeePC.
 
@@ -54,6 +51,32 @@ opt.add_option('-m', '--modify',
 opt.add_option('--encoding',
 	dest="encoding", default="UTF-8")
 
+opt.add_option('--buffer-size',
+	type="int", dest="buffer_size", metavar="BYTES", default=8 << 20,
+	help="approximate limit on the size of files being read ahead "
+		"or written behind, default %default bytes")
+
+opt.add_option('--stats',
+	dest="stats", metavar="FILE",
+	help="write statistics about each file to FILE, as JSON")
+
+opt.add_option('--sidecar',
+	action="store_true", dest="sidecar",
+	help="with --modify, also save what was checked in FILE.quotes, "
+		"for use by --resume")
+
+opt.add_option('--resume',
+	action="store_true", dest="resume",
+	help="with --modify, only check paragraphs which have changed "
+		"since FILE.quotes was saved (implies --sidecar).  The report "
+		"still covers the whole file, but straight quotes are only "
+		"counted where they are converted this time")
+
+opt.add_option('--style',
+	dest="style", default="english", metavar="STYLE",
+	help="conventions for quotation marks: english (the default), "
+		"british, american, french, german or swiss")
+
 
 opt_do = optparse.OptionGroup(opt, 'Operations')
 opt_do.add_option('-a', '--all',
@@ -83,6 +106,10 @@ opt_conf.add_option('--ignore-straight-quotes',
 	help="don't try to convert 'straight' quotation marks "
 		"(this implies they will not be checked at all)")
 
+opt_conf.add_option('--ignore-brackets',
+	action="store_true", dest="ignore_brackets",
+	help="don't check brackets, e.g. in case of false positives")
+
 opt_conf.add_option('--warning-mark',
 	dest="WARN", default=u'#', metavar="MARK",
 	help='warning marker used by most operations, default is "%default"')
@@ -112,26 +139,35 @@ opt_conf.add_option('--max-depth',
 opt.add_option_group(opt_conf)
 
 
-# Now parse arguments
-(options, args) = opt.parse_args()
-
-ops = [option for option in options.__dict__ if option.startswith('do_')]
-
-do_ops = [op for op in ops if getattr(options, op)]
-if not do_ops:
-	# default to --all
-	options.do_all = True
-
-if options.do_all:
-	# --all enables every operation
-	for op in ops:
-		setattr(options, op, True)
-
-
-# Ambiguities and warnings are marked
-# with these characters in our output.
-OUTPUT_MARK = unicode(options.MARK) # "*"
-OUTPUT_WARN = unicode(options.WARN) # "#"
+def parse_options(argv=None):
+	"""Parse command-line arguments, returning (options, args).
+	
+	Exits with a usage message if they are not valid.
+	For the default options, use parse_options([]).
+	"""
+	(options, args) = opt.parse_args(argv)
+	
+	ops = [option for option in options.__dict__ if option.startswith('do_')]
+	
+	do_ops = [op for op in ops if getattr(options, op)]
+	if not do_ops:
+		# default to --all
+		options.do_all = True
+	
+	if options.do_all:
+		# --all enables every operation
+		for op in ops:
+			setattr(options, op, True)
+	
+	if options.style not in PROFILES:
+		opt.error("unknown --style: " + options.style)
+	if options.resume:
+		options.sidecar = True
+	if options.sidecar and not options.modify:
+		opt.error("--sidecar and --resume require --modify")
+	if options.sidecar and options.stats:
+		opt.error("--stats can't be used with --sidecar or --resume")
+	return (options, args)
 
 
 class Counters:
@@ -146,6 +182,7 @@ class Counters:
 		count.unmatched = 0
 
 		count.samequotes = 0
+		count.misordered = 0
 		count.too_deep = 0
 
 		count.spaced_q = 0
@@ -154,8 +191,6 @@ class Counters:
 		count.straight_q = 0
 		count.straight_q2 = 0
 
-counters = Counters()
-
 
 #
 # <reusable>
@@ -196,8 +231,7 @@ PARAGRAPH_ELEMENTS = [
 	'section', 'article',
 	'aside',
 	
-	# At least force paragraph breaks around <pre>,
-	# even if we don't handle the contents correctly.
+	# Each line inside <pre> is also treated as a paragraph
 	'pre',
 ]
 
@@ -209,6 +243,153 @@ PARAGRAPH_ELEMENTS = [
 #
 INVISIBLE_ELEMENTS = ['script', 'style']
 
+#
+# Placeholder "characters", used to represent elements
+# in the input window of TextChecker.
+#
+# Unicode noncharacters are reserved for internal use,
+# so they should never appear in a real document.
+#
+Q_OPEN = u'\uFDD0'	# <q>
+Q_CLOSE = u'\uFDD1'	# </q>
+
+# <br> is whitespace, but two in a row make a paragraph break.
+# LINE SEPARATOR satisfies isbreakspace().
+LINE_BREAK = u'\u2028'
+
+def isbreakspace(c):
+	# NBSP and thin NBSP (Unicode defines more types of spaces,
+	#    but it seems only two type have non-breaking variants)
+	nobreaks = u'\u00A0\u202F'
+	return c.isspace() and c not in nobreaks
+
+# All the characters which satisfy isbreakspace().
+# These are the only spaces Unicode defines (as of 6.0);
+# the filter only drops the non-breaking ones.
+BREAKSPACES = frozenset([c for c in map(unichr,
+	range(0x09, 0x0E) + range(0x1C, 0x21) + [0x85, 0xA0, 0x1680, 0x180E] +
+	range(0x2000, 0x200B) + [0x2028, 0x2029, 0x202F, 0x205F, 0x3000])
+	if isbreakspace(c)])
+
+#
+# APOSTROPHE
+#
+# Where a quotation is closed with the apostrophe character,
+# we can't always tell which one was meant.
+#
+APOSTROPHE = u'’'
+
+# Single quotation marks, as opposed to double quotation marks.
+# Unmatched quotes are counted separately for the two kinds.
+SINGLE_QUOTES = u'‘’‚‹›'
+
+# Roles of punctuation characters in a PunctuationProfile
+OPEN, CLOSE, CLOSE_OR_APOSTROPHE = range(3)
+
+# Spacing rules for quotation marks.
+# Brackets have no spacing rule (None).
+TIGHT = 1	# “like this”
+SPACED = 2	# « like this », with non-breaking spaces
+
+# Input classes, other than straight quotes
+SPACE = u' '
+
+
+class PunctuationProfile(object):
+	"""Conventions for quotation marks and brackets.
+	
+	Compiled into lookup tables when created.
+	"""
+	
+	__slots__ = (
+		# Maps each punctuation character to (role, pair, spacing)
+		'roles',
+		# Characters of the single quotation pairs
+		'singles',
+		# Opening characters of bracket pairs
+		'brackets',
+		# Expected nesting of quotation pairs, outermost first,
+		# repeating as needed.  None allows any order.
+		'order',
+		# Maps input characters which need more than the
+		# punctuation roles to SPACE, or for straight quotes,
+		# to the (open, close) pair they are converted to
+		'inputs',
+	)
+	
+	def __init__(self, pairs, straight_single=None, straight_double=None,
+	             order=None, spaced=(), brackets=(u'()',), apostrophe_closes=None):
+		# Disabled checks are left out of the tables entirely,
+		# so they cost nothing per character.
+		self.roles = {}
+		for pq in brackets:
+			self.roles[pq[0]] = (OPEN, pq, None)
+			self.roles[pq[1]] = (CLOSE, pq, None)
+		for pq in pairs:
+			if pq in spaced:
+				spacing = SPACED
+			else:
+				spacing = TIGHT
+			self.roles[pq[0]] = (OPEN, pq, spacing)
+			if pq[1] == APOSTROPHE:
+				self.roles[pq[1]] = (CLOSE_OR_APOSTROPHE, pq, spacing)
+			else:
+				self.roles[pq[1]] = (CLOSE, pq, spacing)
+		if apostrophe_closes:
+			# The apostrophe is also accepted as the
+			# close-quote of this pair, e.g. from straight quotes
+			self.roles[APOSTROPHE] = (CLOSE_OR_APOSTROPHE, apostrophe_closes,
+			                          self.roles[apostrophe_closes[1]][2])
+		
+		self.singles = frozenset([c for pq in pairs if pq[0] in SINGLE_QUOTES
+		                          for c in pq])
+		self.brackets = frozenset([pq[0] for pq in brackets])
+		self.order = order
+		
+		self.inputs = dict.fromkeys(BREAKSPACES, SPACE)
+		if straight_single:
+			self.inputs[u"'"] = straight_single
+		if straight_double:
+			self.inputs[u'"'] = straight_double
+
+#
+# PROFILES
+#
+# Quotation conventions, selected by --style.
+# Arguments for PunctuationProfile.
+#
+PROFILES = {
+	# Either style of quotes can be used first
+	'english': dict(
+		pairs=[u'‘’', u'“”'],
+		straight_single=u'‘’', straight_double=u'“”'),
+	
+	'british': dict(
+		pairs=[u'‘’', u'“”'], order=[u'‘’', u'“”'],
+		straight_single=u'‘’', straight_double=u'“”'),
+	
+	'american': dict(
+		pairs=[u'“”', u'‘’'], order=[u'“”', u'‘’'],
+		straight_single=u'‘’', straight_double=u'“”'),
+	
+	# An apostrophe is never a close-quote here
+	'french': dict(
+		pairs=[u'«»', u'“”'], order=[u'«»', u'“”'], spaced=[u'«»'],
+		straight_single=u'’’', straight_double=u'«»'),
+	
+	# Straight single quotes could be apostrophes, so they are
+	# converted to ’, which can then close either.
+	'german': dict(
+		pairs=[u'„“', u'‚‘'], order=[u'„“', u'‚‘'],
+		straight_single=u'‚’', straight_double=u'„“',
+		apostrophe_closes=u'‚‘'),
+	
+	'swiss': dict(
+		pairs=[u'«»', u'‹›'], order=[u'«»', u'‹›'],
+		straight_single=u'‹’', straight_double=u'«»',
+		apostrophe_closes=u'‹›'),
+}
+
 
 class XhtmlTokenizer(object):
 	"""Gonzo xhtml tokenizer.
@@ -354,12 +535,6 @@ class XhtmlTokenizer(object):
 			c = self.xml_token = infile.read(1)
 
 
-def isbreakspace(c):
-	# NBSP and thin NBSP (Unicode defines more types of spaces,
-	#    but it seems only two type have non-breaking variants)
-	nobreaks = u'\u00A0\u202F'
-	return c.isspace() and c not in nobreaks
-
 
 # Stack to keep track of the current "open" punctuation marks,
 # with a _limited_ non-deterministic pop() used to handle
@@ -403,6 +578,11 @@ class PunctuationStack(object):
 		else:
 			self._frames.append(PunctuationFrame(p, q))
 	
+	def push(self, p, q):
+		# Like open(), but always starts a new frame.
+		# Used for synthetic punctuation such as <q>.
+		self._frames.append(PunctuationFrame(p, q))
+	
 	def close(self, q):
 		if not self._frames:
 			raise IndexError() # [].pop()
@@ -435,10 +615,41 @@ class PunctuationStack(object):
 # </reusable>
 #
 
+def make_profile(options):
+	# The profile for --style, less anything we were told to ignore
+	settings = dict(PROFILES[options.style])
+	if options.ignore_straight_quotes:
+		settings.update(straight_single=None, straight_double=None)
+	if options.ignore_brackets:
+		settings.update(brackets=())
+	return PunctuationProfile(**settings)
+
 
 class TextChecker(XhtmlTokenizer):
+	"""Checks the quotation marks in a document, writing it to outfile
+	with markers added, and adding up what was found in counters.
+	
+	options are as returned by parse_options().
+	"""
+	
 	__slots__ = ()
 	
+	__slots__ += ('profile', 'counters', 'mark', 'warn', 'max_depth')
+	def options_init(self, options, counters):
+		self.profile = make_profile(options)
+		
+		# Several checkers can add up their results in the same Counters
+		if counters is None:
+			counters = Counters()
+		self.counters = counters
+		
+		# Ambiguities and warnings are marked
+		# with these characters in our output.
+		self.mark = unicode(options.MARK) # "*"
+		self.warn = unicode(options.WARN) # "#"
+		
+		self.max_depth = options.max_depth
+	
 	__slots__ += ('outfile', 'buf')
 	def outfile_init(self, outfile):
 		self.outfile = outfile
@@ -463,93 +674,135 @@ class TextChecker(XhtmlTokenizer):
 		# before any buffered output
 		self.outfile.write(mark)
 
+	__slots__ += ('mark_apostrophe', 'mark_leading_apostrophe',
+	              'mark_mismatch', 'mark_nesting', 'mark_samequotes',
+	              'mark_spacing', 'do_mismatch')
+	def marks_init(self, options):
+		# Each check writes markers through its own function,
+		# chosen once here, so the options are never tested
+		# while checking.
+		def no_mark(mark):
+			pass
+		def marker(enabled):
+			if enabled:
+				return self.output_mark
+			return no_mark
+		
+		self.mark_apostrophe = marker(options.do_apostrophe)
+		self.mark_leading_apostrophe = marker(options.do_apostrophe and
+		                                      not options.skip_leading_apostrophe)
+		self.mark_mismatch = marker(options.do_mismatch)
+		self.mark_nesting = marker(options.do_nesting)
+		self.mark_samequotes = marker(options.do_nesting and
+		                              not options.allow_same_quotes)
+		self.mark_spacing = marker(options.do_spacing)
+		
+		# Quotes left open at the end of a paragraph
+		# are only counted by --mismatch
+		self.do_mismatch = options.do_mismatch
+
 	__slots__ += ('punct',)
 	def punctuation_init(self):
 		self.punct = PunctuationStack()
 
 	def punctuation_open(self, pq):
 		(p, q) = pq
+		if self.profile.order and p not in self.profile.brackets:
+			self.punctuation_order_check(pq)
 		self.punct.open(p, q)
 		
 		samecount = self.punct.top().opened - self.punct.top().maybe_closed
 		if samecount > 1:
-			if options.do_nesting and not options.allow_same_quotes:
-				self.output_mark(OUTPUT_WARN)
-			counters.samequotes += 1
+			self.mark_samequotes(self.warn)
+			self.counters.samequotes += 1
 	
+		self.punctuation_depth_check()
+
+	def punctuation_push(self, pq):
+		# Open a synthetic frame, e.g. for <q>.
+		# Browsers alternate the quote style for nested <q>,
+		# so this never counts as using the same quotes.
+		(p, q) = pq
+		self.punct.push(p, q)
+		self.punctuation_depth_check()
+
+	def punctuation_order_check(self, pq):
+		level = sum([s.opened - s.maybe_closed for s in self.punct._frames
+		             if s.p not in self.profile.brackets])
+		expected = self.profile.order[level % len(self.profile.order)]
+		if pq != expected:
+			self.mark_nesting(self.warn + u'[' + expected[0] + u']')
+			self.counters.misordered += 1
+
+	def punctuation_depth_check(self):
 		d = sum([s.opened - s.maybe_closed for s in self.punct._frames])
-		if d > options.max_depth:
-			if options.do_nesting:
-				self.output_mark(OUTPUT_WARN + u'[' + unicode(d) + u']')
-			counters.too_deep += 1
+		if d > self.max_depth:
+			self.mark_nesting(self.warn + u'[' + unicode(d) + u']')
+			self.counters.too_deep += 1
 
 	def punctuation_close(self, q):
 		try:
 			self.punct.close(q)
 		except IndexError:
 			# Punctuation stack was empty
-			if q == u"’":
-				counters.unmatched_q += 1
+			if q in self.profile.singles:
+				self.counters.unmatched_q += 1
 			else:
-				counters.unmatched += 1
+				self.counters.unmatched += 1
 			
-			if options.do_mismatch:
-				self.output_mark(OUTPUT_WARN)
+			self.mark_mismatch(self.warn)
 		except ValueError:
 			# q did not match the top of the punctuation stack
 			if len(self.punct._frames) >= 2 and q == self.punct._frames[-2].q and \
 			   self.punct.top().maybe_closed == self.punct.top().opened:
 				# Looks like the apostrophes we noted might have been close-quotes
-				if options.do_apostrophe:
-					self.output_mark(' ' + OUTPUT_MARK * self.punct.top().maybe_closed)
+				self.mark_apostrophe(u' ' + self.mark * self.punct.top().maybe_closed)
 				# Pop all the apostrophes 
 				self.punct.close_maybes()
 				# Now we can close q without any problem
 				self.punct.close(q)
 			else:
-				if options.do_mismatch:
-					self.output_mark(OUTPUT_WARN + u'[' + self.punct.top().p + u']')
+				self.mark_mismatch(self.warn + u'[' + self.punct.top().p + u']')
 				# No attempt at recovery here. We may
 				# generate some confusing-looking errors
 				# until we get to the next paragraph,
 				# though they're still possible to understand
 				# if you know what we're doing.
-				if q == u"’" or self.punct.top().p == u"‘":
-					counters.unmatched_q += 1
+				if q in self.profile.singles or self.punct.top().p in self.profile.singles:
+					self.counters.unmatched_q += 1
 				else:
-					counters.unmatched += 1
+					self.counters.unmatched += 1
 
 	def punctuation_maybe_close(self, q):
-		if options.do_apostrophe:
-			self.output_mark(OUTPUT_MARK)
+		self.mark_apostrophe(self.mark)
 		
 		self.punct.maybe_close(q)
 
 	def punctuation_endpara(self):
 		if self.punct and self.punct.top().maybe_closed > 0:
 			# Looks like some of the apostrophes we noted might have been close-quotes
-			if options.do_apostrophe:
-				self.output_mark(u' ' + OUTPUT_MARK * self.punct.top().maybe_closed)
+			self.mark_apostrophe(u' ' + self.mark * self.punct.top().maybe_closed)
 			# So let's close the same number of open-quotes
 			self.punct.close_maybes()
 
 		if self.punct:
-			if options.do_mismatch:
-				self.output_mark(u' ' + OUTPUT_WARN + u'[')
+			if self.do_mismatch:
+				self.output_mark(u' ' + self.warn + u'[' +
+				                 u''.join([frame.p for frame in self.punct._frames]) +
+				                 u']')
 				for frame in self.punct._frames:
-					self.output_mark(frame.p)
-					
 					# This may cause some errors to be counted twice
-					if frame.p == u"‘":
-						counters.unmatched_q += 1
+					if frame.p in self.profile.singles:
+						self.counters.unmatched_q += 1
 					else:
-						counters.unmatched += 1
-				self.output_mark(u']')
+						self.counters.unmatched += 1
 			self.punct._frames = []
 	
-	__slots__ += ('history', 'hidden_element')
-	def __init__(self, outfile):
+	__slots__ += ('history', 'hidden_depth', 'pre_depth')
+	def __init__(self, outfile, options, counters=None):
+		self.options_init(options, counters)
 		self.outfile_init(outfile)
+		self.marks_init(options)
 		self.punctuation_init()
 
 		# An input window of three "characters".
@@ -561,7 +814,9 @@ class TextChecker(XhtmlTokenizer):
 		# using output_mark()
 		self.history = [u"\n", u"\n", u"\n"]
 
-		self.hidden_element = []
+		# Nesting depth of INVISIBLE_ELEMENTS, and <pre>
+		self.hidden_depth = 0
+		self.pre_depth = 0
 
 
 	def __character(self, next):
@@ -571,132 +826,191 @@ class TextChecker(XhtmlTokenizer):
 
 		(prev, cur) = (self.history[-2], self.history[-1])
 
-		if not options.ignore_straight_quotes:
-			if next == u"'":
-				counters.straight_q += 1
-				if isbreakspace(cur):
-					# Could be open-quote OR leading apostrophe.
-					# We assume open-quote.
-					# If we get it wrong, it should get flagged as a quote mismatch error
-					#  - unless there is an ambiguous trailing apostrophe - which is what
-					# the ambiguity markers are there for.
-					next = u"‘"
-				else:
-					next = u"’"
-				self.xml_token = next
-				
-			elif next == u'"':
-				counters.straight_q2 += 1
-				if isbreakspace(cur):
-					next = u'“'
-				else:
-					next = u'”'
-				self.xml_token = next
-
-		# Done rewriting; update history
+		# Update history
 		del self.history[0]
 		self.history.append(next)
 		
-		# TODO: make optional, in case of non-standard usage?
-		if cur == u'(':
-			self.punctuation_open(u'()')
-		elif cur == u')':
-			self.punctuation_close(u')')
-
-		elif cur == u'“':
-			if prev.isalnum():
-				counters.unspaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			if isbreakspace(next):
-				counters.spaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			self.punctuation_open(u'“”')
-		elif cur == u'”':
-			if isbreakspace(prev):
-				counters.spaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			if next.isalnum():
-				counters.unspaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			self.punctuation_close(u'”')
-
-		# Open quote
-		elif cur == u"‘":
-			counters.openq += 1
-			if prev.isalnum():
-				counters.unspaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			if isbreakspace(next):
-				counters.spaced_q += 1
-				if options.do_spacing:
-					self.output_mark(OUTPUT_WARN)
-			self.punctuation_open(u"‘’")
-
-		elif cur == u"’":
+		role = self.profile.roles.get(cur)
+		if role is None:
+			return
+		(kind, pq, spacing) = role
+
+		if kind == OPEN:
+			if cur in self.profile.singles:
+				self.counters.openq += 1
+			if spacing:
+				self.spacing_open(spacing, prev, next)
+			self.punctuation_open(pq)
+
+		elif kind == CLOSE:
+			if cur in self.profile.singles:
+				self.counters.closeq += 1
+			if spacing:
+				self.spacing_close(spacing, prev, next)
+			self.punctuation_close(pq[1])
+
+		else: # CLOSE_OR_APOSTROPHE
 			if prev.isalnum():
 				if next.isalpha():
 					# Internal, must be apostrophe
 					pass
 				else:
 					# Ambiguous - could be end-of-word apostrophe OR closing quote
-					counters.ambiguous_apostrophe += 1
-					self.punctuation_maybe_close(u"’")
+					self.counters.ambiguous_apostrophe += 1
+					self.punctuation_maybe_close(pq[1])
 			else:
 				if next.isalnum():
 					# Should be a start-of-word apostrophe - 
 					# but there's a possibility it's a wrongly-angled opening quote,
 					# and there's usually not too many of these to check.
-					counters.leading_apostrophe += 1
-					if options.do_apostrophe and \
-					   not options.skip_leading_apostrophe:
-						self.output_mark(OUTPUT_MARK)
+					self.counters.leading_apostrophe += 1
+					self.mark_leading_apostrophe(self.mark)
 				else:
 					if isbreakspace(prev):
-						counters.spaced_q += 1
-						if options.do_spacing:				
-							self.output_mark(OUTPUT_WARN)
+						self.counters.spaced_q += 1
+						self.mark_spacing(self.warn)
 					# Not attached to word - must be a closing quote
-					counters.closeq += 1
-					self.punctuation_close(u"’")
-
-	def character_data(self, c):	
-		if not self.hidden_element:
-			# All whitespace characters are treated the same
-			# (apart from NBSP)
-			if isbreakspace(c):
-				c = u' '
-			self.__character(c)
+					self.counters.closeq += 1
+					self.punctuation_close(pq[1])
+
+	def spacing_open(self, spacing, prev, next):
+		if prev.isalnum():
+			self.counters.unspaced_q += 1
+			self.mark_spacing(self.warn)
+		if isbreakspace(next):
+			# SPACED quotes should use a non-breaking space
+			self.counters.spaced_q += 1
+			self.mark_spacing(self.warn)
+		elif spacing == SPACED and next.isalnum():
+			self.counters.unspaced_q += 1
+			self.mark_spacing(self.warn)
+
+	def spacing_close(self, spacing, prev, next):
+		if isbreakspace(prev):
+			self.counters.spaced_q += 1
+			self.mark_spacing(self.warn)
+		elif spacing == SPACED and prev.isalnum():
+			self.counters.unspaced_q += 1
+			self.mark_spacing(self.warn)
+		if next.isalnum():
+			self.counters.unspaced_q += 1
+			self.mark_spacing(self.warn)
+
+	def character_data(self, c):
+		if not self.hidden_depth:
+			kind = self.profile.inputs.get(c)
+			if kind is None:
+				self.__character(c)
+			elif kind == SPACE:
+				# All whitespace characters are treated the same
+				# (apart from NBSP), and a run of whitespace
+				# only enters the input window once.
+				if c == u'\n' and self.pre_depth:
+					self.__paragraph_break()
+				elif not isbreakspace(self.history[-1]):
+					self.__character(SPACE)
+			else:
+				self.__straight_quote(c, kind)
 		self.flush_tokens()
 
+	def __straight_quote(self, c, pq):
+		# Rewrite "token" (the representation of "c")
+		# with the curly quote from the pair "pq"
+		if c == u"'":
+			self.counters.straight_q += 1
+		else:
+			self.counters.straight_q2 += 1
+		
+		cur = self.history[-1]
+		if isbreakspace(cur) or cur == Q_OPEN:
+			# Could be open-quote OR leading apostrophe.
+			# We assume open-quote.
+			# If we get it wrong, it should get flagged as a quote mismatch error
+			#  - unless there is an ambiguous trailing apostrophe - which is what
+			# the ambiguity markers are there for.
+			c = pq[0]
+		else:
+			c = pq[1]
+		self.xml_token = c
+		self.__character(c)
+
 	def __paragraph_break(self):
 		self.__character(u'\n')
 		self.punctuation_endpara()
 
-	def start_element(self, name, *_):
-		name = name.lower()
-		if name in INVISIBLE_ELEMENTS:
-			self.hidden_element.append(name)
-		if name in PARAGRAPH_ELEMENTS:
+	# The content of INVISIBLE_ELEMENTS can look like markup
+	# (e.g. a string in a script), so <br>, <q> and <pre>
+	# only count outside them.
+	def __line_break(self):
+		if self.hidden_depth:
+			return
+		if self.history[-1] == LINE_BREAK:
 			self.__paragraph_break()
+		else:
+			self.__character(LINE_BREAK)
+
+	# A stray end tag is ignored, so it can't
+	# affect the rest of the document.
+	def __start_hidden(self):
+		self.hidden_depth += 1
+
+	def __end_hidden(self):
+		if self.hidden_depth:
+			self.hidden_depth -= 1
+
+	def __start_pre(self):
+		self.__paragraph_break()
+		if not self.hidden_depth:
+			self.pre_depth += 1
+
+	def __end_pre(self):
+		self.__paragraph_break()
+		if self.pre_depth and not self.hidden_depth:
+			self.pre_depth -= 1
+
+	# <q> is processed in sequence with the surrounding text,
+	# i.e. after the pending character in the input window.
+	def __start_q(self):
+		if self.hidden_depth:
+			return
+		self.__character(Q_OPEN)
+		self.punctuation_push((u'q', Q_CLOSE))
+
+	def __end_q(self):
+		if self.hidden_depth:
+			return
+		self.__character(Q_CLOSE)
+		self.punctuation_close(Q_CLOSE)
+
+	# Dispatch tables for element callbacks, by lower-case element name.
+	# Elements without an entry only have their token saved.
+	start_handlers = dict.fromkeys(PARAGRAPH_ELEMENTS, __paragraph_break)
+	start_handlers.update(dict.fromkeys(INVISIBLE_ELEMENTS, __start_hidden))
+	start_handlers.update(pre=__start_pre, q=__start_q, br=__line_break)
+
+	end_handlers = dict.fromkeys(PARAGRAPH_ELEMENTS, __paragraph_break)
+	end_handlers.update(dict.fromkeys(INVISIBLE_ELEMENTS, __end_hidden))
+	end_handlers.update(pre=__end_pre, q=__end_q)
+
+	empty_handlers = dict.fromkeys(PARAGRAPH_ELEMENTS, __paragraph_break)
+	empty_handlers.update(br=__line_break)
+
+	def start_element(self, name):
+		handler = self.start_handlers.get(name.lower())
+		if handler is not None:
+			handler(self)
 		self.save_token()
 
 	def end_element(self, name):
-		name = name.lower()
-		if name in INVISIBLE_ELEMENTS:
-			self.hidden_element.pop()
-		if name in PARAGRAPH_ELEMENTS:
-			self.__paragraph_break()
+		handler = self.end_handlers.get(name.lower())
+		if handler is not None:
+			handler(self)
 		self.save_token()
 
 	def empty_element(self, name):
-		name = name.lower()
-		if name in PARAGRAPH_ELEMENTS:
-			self.__paragraph_break()
+		handler = self.empty_handlers.get(name.lower())
+		if handler is not None:
+			handler(self)
 		self.save_token()
 	
 	def noncharacter_data(self):
@@ -707,95 +1021,606 @@ class TextChecker(XhtmlTokenizer):
 		self.flush_tokens()
 
 
-infile = sys.stdin
-outfile = sys.stdout
-
-# python2: fallback to get unicode stdin/stdout
-# (twice as slow... though at least it respects --encoding, unlike what'll happen with python3)
-if hasattr(infile.read(0), 'decode'):
-	import codecs
-	infile = codecs.getreader(options.encoding)(infile)
-	outfile = codecs.getwriter(options.encoding)(outfile, errors='xmlcharrefreplace')
-
-#class NullWriter:
-#	def write(self, d):
-#		pass
-#	def flush(self):
-#		pass
-#	def close(self):
-#		pass
-#outfile = NullWriter()
-
-if not args:
-	if options.modify:
-		print("--modify requires at least one filename")
-		sys.exit(1)
-	
-	TextChecker(outfile).run(infile)
-else:
-	if os.name != 'posix':
-		filenames = []
-		for filename in args:
-			filenames += glob.glob(filename)
-		args = filenames
-
-	for filename in args:
-		infile = io.open(filename, 'r', encoding=options.encoding, newline='\n')
-		if options.modify:
-			outfile = io.open(filename+".tmp", 'w', encoding=options.encoding, errors='xmlcharrefreplace', newline='\n')
+class Statistics(object):
+	"""Measurements of one file, made by InstrumentedTextChecker.
+	
+	These help to explain why a document takes a long time
+	or a lot of memory to check.
+	"""
+	
+	__slots__ = (
+		'characters',		# including entities and CDATA
+		'hidden_characters',	# in INVISIBLE_ELEMENTS, not counted above
+		'tags',
+		'comments',
+		'cdata',		# CDATA sections
+		'entities',
+		'other_tokens',		# DOCTYPE and processing instructions
+		'max_punctuation_depth',
+		'max_buffered_tokens',
+		'paragraphs',		# not counting blank paragraphs
+		'paragraph_lengths',	# histogram, see add_paragraph()
+	)
+	
+	def __init__(self):
+		for name in self.__slots__:
+			setattr(self, name, 0)
+		self.paragraph_lengths = {}
+	
+	def add_paragraph(self, length):
+		# The histogram buckets are powers of two;
+		# a paragraph of 5 characters is counted under 4.
+		self.paragraphs += 1
+		bucket = 1 << (length.bit_length() - 1)
+		self.paragraph_lengths[bucket] = self.paragraph_lengths.get(bucket, 0) + 1
+	
+	def as_dict(self):
+		d = dict([(name, getattr(self, name)) for name in self.__slots__])
+		d['paragraph_lengths'] = dict([(str(bucket), n) for (bucket, n)
+		                               in sorted(self.paragraph_lengths.items())])
+		return d
+
+
+class InstrumentedTextChecker(TextChecker):
+	"""TextChecker which also collects Statistics.
+	
+	This is a separate class so the measurements cost
+	nothing when they are not wanted.
+	"""
+	
+	__slots__ = ('stats', 'paragraph_start', 'paragraph_blank')
+	def __init__(self, outfile, options, counters=None):
+		TextChecker.__init__(self, outfile, options, counters)
+		self.stats = Statistics()
+		self.paragraph_start = 0
+		self.paragraph_blank = True
+	
+	def run(self, infile):
+		TextChecker.run(self, infile)
+		self.end_paragraph()
+	
+	def end_paragraph(self):
+		if not self.paragraph_blank:
+			self.stats.add_paragraph(self.stats.characters - self.paragraph_start)
+		self.paragraph_start = self.stats.characters
+		self.paragraph_blank = True
+	
+	def character_data(self, c):
+		# Paragraphs are measured in the text we check
+		if self.hidden_depth:
+			self.stats.hidden_characters += 1
+		else:
+			self.stats.characters += 1
+			if self.paragraph_blank and not c.isspace():
+				self.paragraph_blank = False
+		if self.xml_token[:1] == u'&':
+			self.stats.entities += 1
+		TextChecker.character_data(self, c)
+	
+	def noncharacter_data(self):
+		token = self.xml_token
+		if token.startswith(u'<!--'):
+			self.stats.comments += 1
+		elif token == u'<![CDATA[':
+			self.stats.cdata += 1
+		elif token != u']]>':
+			self.stats.other_tokens += 1
+		TextChecker.noncharacter_data(self)
+	
+	def start_element(self, name):
+		self.stats.tags += 1
+		TextChecker.start_element(self, name)
+	
+	def end_element(self, name):
+		self.stats.tags += 1
+		TextChecker.end_element(self, name)
+	
+	def empty_element(self, name):
+		self.stats.tags += 1
+		TextChecker.empty_element(self, name)
+	
+	def save_token(self):
+		TextChecker.save_token(self)
+		if len(self.buf) > self.stats.max_buffered_tokens:
+			self.stats.max_buffered_tokens = len(self.buf)
+	
+	def punctuation_depth_check(self):
+		TextChecker.punctuation_depth_check(self)
+		depth = sum([s.opened for s in self.punct._frames])
+		if depth > self.stats.max_punctuation_depth:
+			self.stats.max_punctuation_depth = depth
+	
+	def punctuation_endpara(self):
+		TextChecker.punctuation_endpara(self)
+		self.end_paragraph()
+
+
+class RecordingTextChecker(TextChecker):
+	"""TextChecker which records where it can be resumed.
+	
+	A checkpoint is the start of a line where the checker has just
+	made a paragraph break, with nothing carried over except the
+	depth of <pre> and invisible elements.  Checking can start again
+	from any checkpoint with a new TextChecker, and give the same
+	results.
+	
+	The output is divided into regions, starting at checkpoints
+	at least REGION_SIZE characters apart.  For each region we
+	record the counters, as a flat list of (index, increase)
+	indexing SAVED_COUNTERS.
+	"""
+	
+	__slots__ = ('in_cdata', 'checkpoints', 'counts', 'snapshot',
+	             'infile', 'resync')
+	def __init__(self, outfile, options, counters=None, hidden_depth=0, pre_depth=0):
+		TextChecker.__init__(self, outfile, options, counters)
+		self.hidden_depth = hidden_depth
+		self.pre_depth = pre_depth
+		self.in_cdata = False
+		
+		# (output offset, hidden_depth, pre_depth)
+		self.checkpoints = [(0, hidden_depth, pre_depth)]
+		# Counters which changed in each region so far
+		self.counts = []
+		self.snapshot = vars(self.counters).copy()
+		# Called as resync(input offset, (hidden_depth, pre_depth))
+		# at each place a checkpoint could be.  If it returns True,
+		# checking stops there with BackInStep.
+		self.resync = None
+	
+	def run(self, infile):
+		self.infile = infile
+		TextChecker.run(self, infile)
+	
+	def noncharacter_data(self):
+		if self.xml_token == u'<![CDATA[':
+			self.in_cdata = True
+		elif self.xml_token == u']]>':
+			self.in_cdata = False
+		TextChecker.noncharacter_data(self)
+	
+	def character_data(self, c):
+		TextChecker.character_data(self, c)
+		if c == u'\n' and self.xml_token == u'\n' and \
+		   self.history[-1] == u'\n' and not self.in_cdata:
+			if self.resync and \
+			   self.resync(self.infile.tell(), (self.hidden_depth, self.pre_depth)):
+				raise BackInStep()
+			if self.outfile.tell() - self.checkpoints[-1][0] >= REGION_SIZE:
+				self.checkpoint()
+	
+	def checkpoint(self):
+		now = vars(self.counters)
+		counts = []
+		for (i, name) in enumerate(SAVED_COUNTERS):
+			if now[name] != self.snapshot[name]:
+				counts += [i, now[name] - self.snapshot[name]]
+		self.counts.append(counts)
+		self.snapshot = now.copy()
+		self.checkpoints.append((self.outfile.tell(), self.hidden_depth, self.pre_depth))
+	
+	def regions(self, output):
+		# Returns the list of regions for the sidecar file,
+		# [lines, hash, hidden_depth, pre_depth, counts]
+		#
+		# The last region runs to the end of the output.
+		self.checkpoint()
+		ends = [offset for (offset, _, _) in self.checkpoints[1:]]
+		
+		regions = []
+		for ((start, hidden, pre), end, counts) in zip(self.checkpoints, ends, self.counts):
+			text = output[start:end]
+			regions.append([text.count(u'\n'), region_hash(text),
+			                hidden, pre, counts])
+		return regions
+
+
+class BackInStep(Exception):
+	"""Stops a RecordingTextChecker, see its "resync" attribute."""
+
+
+# Regions are at least this many characters, to keep the sidecar small.
+# An edit means checking at least the whole region it falls in.
+REGION_SIZE = 4096
+
+# Straight quote counts describe the conversion, not the output,
+# so they are not saved.  A region which is reused has already
+# been converted.
+SAVED_COUNTERS = [name for name in sorted(vars(Counters()))
+                  if name not in ('straight_q', 'straight_q2')]
+
+def region_hash(text):
+	return zlib.crc32(text.encode('UTF-8')) & 0xffffffff
+
+def line_starts(text):
+	# Offsets of the start of each line, including
+	# a last line after a trailing newline (which is empty),
+	# followed by the end of the text.
+	starts = [0]
+	i = text.find(u'\n')
+	while i >= 0:
+		starts.append(i + 1)
+		i = text.find(u'\n', i + 1)
+	starts.append(len(text))
+	return starts
+
+def sidecar_options(options):
+	# Options which affect the output, and the meaning of the counts
+	settings = dict([(name, getattr(options, name)) for name in (
+		'encoding', 'style', 'ignore_straight_quotes', 'ignore_brackets',
+		'do_apostrophe', 'do_mismatch', 'do_spacing', 'do_nesting',
+		'skip_leading_apostrophe', 'allow_same_quotes', 'max_depth',
+		'MARK', 'WARN')])
+	settings['counters'] = SAVED_COUNTERS
+	return settings
+
+def check_regions(text, options, counters, hidden_depth=0, pre_depth=0, resync=None):
+	# Check text, returning (output, regions).
+	# Checking stops early if resync() says so (see RecordingTextChecker),
+	# otherwise it runs to the end of the file.
+	#
+	# At the end of the file, the last region has one more
+	# line than it has newlines (which may be empty).
+	checked = io.StringIO()
+	checker = RecordingTextChecker(checked, options, counters, hidden_depth, pre_depth)
+	checker.resync = resync
+	at_end = True
+	if text:
+		# (the tokenizer can't handle empty files)
+		try:
+			checker.run(io.StringIO(text))
+		except BackInStep:
+			at_end = False
+	output = checked.getvalue()
+	regions = checker.regions(output)
+	if at_end:
+		regions[-1][0] += 1
+	return (output, regions)
+
+# After an edited region, unchanged regions are searched for
+# in this many regions, and this many lines either side of
+# where they were before.
+RESYNC_REGIONS = 50
+RESYNC_LINES = 5
+
+def resume_regions(text, old, options, counters):
+	# Check text, which is the output described by the regions "old"
+	# with some changes.  Returns (output, regions).
+	#
+	# Each unchanged region keeps its output and counts.
+	# Edited regions are checked again, continuing until the
+	# checker gets back in step with an unchanged region.
+	starts = line_starts(text)
+	nlines = len(starts) - 1
+	
+	def matches(region, line):
+		end = line + region[0]
+		if end > nlines or (region is old[-1] and end != nlines):
+			return False
+		return region_hash(text[starts[line]:starts[end]]) == region[1]
+	
+	def candidates(i, line):
+		# Unchanged regions after old[i], which is expected at "line".
+		# Returns {line: index in old}.
+		found = {}
+		first_line = line
+		for j in range(i + 1, min(i + 1 + RESYNC_REGIONS, len(old))):
+			line += old[j - 1][0]
+			for delta in range(RESYNC_LINES + 1):
+				for guess in (line + delta, line - delta):
+					if guess >= first_line and guess not in found and \
+					   matches(old[j], guess):
+						found[guess] = j
+		return found
+	
+	output = []
+	regions = []
+	i = 0
+	line = 0
+	while i < len(old):
+		region = old[i]
+		if matches(region, line):
+			output.append(text[starts[line]:starts[line + region[0]]])
+			regions.append(region)
+			counts = region[4]
+			for k in range(0, len(counts), 2):
+				name = SAVED_COUNTERS[counts[k]]
+				setattr(counters, name, getattr(counters, name) + counts[k + 1])
+			line += region[0]
+			i += 1
+			continue
 		
-		TextChecker(outfile).run(infile)
+		found = candidates(i, line)
+		j = found.get(line)
+		if j is not None and old[j][2:4] == region[2:4]:
+			# old[i] was removed
+			i = j
+			continue
 		
+		# Check forward from here, in one pass.  We're back in step
+		# at a place there could be a checkpoint, which is the start
+		# of an unchanged region, with the state the region started from.
+		start = starts[line]
+		stop = []
+		def resync(offset, state):
+			n = bisect.bisect_left(starts, start + offset)
+			j = found.get(n)
+			if j is not None and list(state) == old[j][2:4]:
+				stop.append((j, n))
+				return True
+			return False
+		
+		(hidden, pre) = region[2:4]
+		(checked, new) = check_regions(text[start:], options, counters,
+		                               hidden, pre, resync)
+		if stop:
+			# (the last region ends here, it is never empty)
+			(i, line) = stop[0]
+		else:
+			(i, line) = (len(old), nlines)
+		output.append(checked)
+		regions.extend(new)
+	
+	return (u''.join(output), regions)
+
+def check_with_sidecar(text, sidecar, options, counters):
+	# Returns (output, new sidecar).
+	# "sidecar" is the previous sidecar for --resume, or None.
+	if sidecar and sidecar.get('options') == sidecar_options(options):
+		(output, regions) = resume_regions(text, sidecar['regions'], options, counters)
+	else:
+		(output, regions) = check_regions(text, options, counters)
+	return (output, {'options': sidecar_options(options), 'regions': regions})
+
+
+class ByteBudget(object):
+	"""Limit on the total size of files held in memory."""
+	
+	def __init__(self, limit):
+		self.limit = limit
+		self.used = 0
+		self.cond = threading.Condition()
+	
+	def acquire(self, size):
+		with self.cond:
+			# A file larger than the limit is allowed on its own
+			while self.used and self.used + size > self.limit:
+				self.cond.wait()
+			self.used += size
+	
+	def release(self, size):
+		with self.cond:
+			self.used -= size
+			self.cond.notify_all()
+
+# python2: waiting on a queue or thread without a timeout
+# ignores Ctrl-C, so we wait in a loop.
+WAIT_TIMEOUT = 1.0
+
+def queue_get(queue):
+	while True:
+		try:
+			return queue.get(timeout=WAIT_TIMEOUT)
+		except Queue.Empty:
+			pass
+
+def thread_join(thread):
+	while thread.is_alive():
+		thread.join(WAIT_TIMEOUT)
+
+SIDECAR = ".quotes"
+
+def read_files(filenames, options, budget, inputs):
+	# Queue up (filename, text, size, sidecar) for each file,
+	# then None.  Stops at the first error, queueing the exception.
+	# sidecar is only read for --resume, otherwise it is None.
+	#
+	# The budget for each file is released by write_files().
+	for filename in filenames:
+		try:
+			size = os.path.getsize(filename)
+			budget.acquire(size)
+			infile = io.open(filename, 'r', encoding=options.encoding, newline='\n')
+			try:
+				text = infile.read()
+			finally:
+				infile.close()
+			
+			sidecar = None
+			if options.resume and os.path.exists(filename+SIDECAR):
+				with open(filename+SIDECAR) as f:
+					sidecar = json.load(f)
+		except Exception as e:
+			inputs.put(e)
+			return
+		inputs.put((filename, text, size, sidecar))
+	inputs.put(None)
+
+def write_files(outputs, options, outfile, budget, errors):
+	# Write each (filename, text, size, sidecar) from the queue,
+	# until None.  After an error, the rest are discarded.
+	while True:
+		item = queue_get(outputs)
+		if item is None:
+			return
+		
+		(filename, text, size, sidecar) = item
+		try:
+			if errors:
+				pass
+			elif options.modify:
+				f = io.open(filename+".tmp", 'w', encoding=options.encoding, errors='xmlcharrefreplace', newline='\n')
+				try:
+					f.write(text)
+				finally:
+					f.close()
+				os.rename(filename+".tmp", filename)
+				
+				if sidecar:
+					with open(filename+SIDECAR+".tmp", 'w') as f:
+						json.dump(sidecar, f, separators=(',', ':'))
+					os.rename(filename+SIDECAR+".tmp", filename+SIDECAR)
+			else:
+				outfile.write(text)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			budget.release(size)
+
+def write_report(report, counters, options):
+	report.write("\nSingle quotes")
+	report.write("\n                    open quotes: " + str(counters.openq))
+	report.write("\n       unambiguous close quotes: " + str(counters.closeq))
+	report.write("\n")
+
+	report.write("\nApostrophes")
+	report.write("\n    apostrophe at start of word: " + str(counters.leading_apostrophe))
+	report.write("\n    ambiguous close-quote /")
+	report.write("\n      apostrophe at end of word: " + str(counters.ambiguous_apostrophe))
+	report.write("\n")
+
+	report.write("\nUnmatched quotes and brackets")
+	report.write("\n   single quotes (conservative): " + str(counters.unmatched_q))
+	report.write("\n   double quotes and brackets  : " + str(counters.unmatched))
+	report.write("\n")
+
+	report.write("\nNested quotations")
+	report.write("\n          nested " + str(options.max_depth + 1) +
+	                                 " deep or more: " + str(counters.too_deep))
+	report.write("\n      with same style of quotes: " + str(counters.samequotes))
+	if make_profile(options).order:
+		report.write("\n      not in the expected order: " + str(counters.misordered))
+	report.write("\n")
+
+	# TODO this is documentation:
+	#  - check cases with no spaces, which might have been mis-handled
+	#  - this will also happen to flag up:
+	#    - extra spaces from OCR, which can often cause quotes to go in the wrong direction
+	#    - absence of NBSP in adjacent nested quotation marks
+	#    - absence of NBSP around en dash just inside quotation mark
+	#    - as above, for spaced out elipsis
+	#    (and any similar unsual typographic features)
+	# 
+	# TODO need to document NBSP specifically, because the distinction is technical and not obvious to the eye
+
+	report.write("\nQuote spacing")
+	report.write("\n              unexpected spaces: " + str(counters.spaced_q))
+	report.write("\n                 missing spaces: " + str(counters.unspaced_q))
+	report.write("\n")
+
+	# TODO document as defaulting to open-quotes (with user free to search+replace all)
+	report.write("\nStraight quote characters")
+	report.write("\n         straight single quotes: " + str(counters.straight_q))
+	report.write("\n         straight double quotes: " + str(counters.straight_q2))
+	report.write("\n")
+
+def main(argv=None):
+	(options, args) = parse_options(argv)
+	counters = Counters()
+
+	infile = sys.stdin
+	outfile = sys.stdout
+
+	# python2: fallback to get unicode stdin/stdout
+	# (twice as slow... though at least it respects --encoding, unlike what'll happen with python3)
+	if hasattr(infile.read(0), 'decode'):
+		import codecs
+		infile = codecs.getreader(options.encoding)(infile)
+		outfile = codecs.getwriter(options.encoding)(outfile, errors='xmlcharrefreplace')
+
+	#class NullWriter:
+	#	def write(self, d):
+	#		pass
+	#	def flush(self):
+	#		pass
+	#	def close(self):
+	#		pass
+	#outfile = NullWriter()
+
+	if options.stats:
+		Checker = InstrumentedTextChecker
+	else:
+		Checker = TextChecker
+
+	# List of (filename, Statistics)
+	file_stats = []
+
+	if not args:
 		if options.modify:
-			os.rename(filename+".tmp", filename)
-			outfile.close()
+			print("--modify requires at least one filename")
+			return 1
+		
+		checker = Checker(outfile, options, counters)
+		checker.run(infile)
+		if options.stats:
+			file_stats.append(('-', checker.stats))
+	else:
+		if os.name != 'posix':
+			filenames = []
+			for filename in args:
+				filenames += glob.glob(filename)
+			args = filenames
+
+		# Files are read ahead and written behind in background threads,
+		# while this thread checks them.  Network filesystems can take
+		# longer than the checking.
+		budget = ByteBudget(options.buffer_size)
+		inputs = Queue.Queue()
+		outputs = Queue.Queue()
+		write_errors = []
 		
-		infile.close()
-
-if not options.modify:
-	outfile.flush()
-
-report = sys.stderr
-report.write("\nSingle quotes")
-report.write("\n                    open quotes: " + str(counters.openq))
-report.write("\n       unambiguous close quotes: " + str(counters.closeq))
-report.write("\n")
-
-report.write("\nApostrophes")
-report.write("\n    apostrophe at start of word: " + str(counters.leading_apostrophe))
-report.write("\n    ambiguous close-quote /")
-report.write("\n      apostrophe at end of word: " + str(counters.ambiguous_apostrophe))
-report.write("\n")
-
-report.write("\nUnmatched quotes and brackets")
-report.write("\n   single quotes (conservative): " + str(counters.unmatched_q))
-report.write("\n   double quotes and brackets  : " + str(counters.unmatched))
-report.write("\n")
-
-report.write("\nNested quotations")
-report.write("\n          nested " + str(options.max_depth + 1) +
-                                 " deep or more: " + str(counters.too_deep))
-report.write("\n      with same style of quotes: " + str(counters.samequotes))
-report.write("\n")
-
-# TODO this is documentation:
-#  - check cases with no spaces, which might have been mis-handled
-#  - this will also happen to flag up:
-#    - extra spaces from OCR, which can often cause quotes to go in the wrong direction
-#    - absence of NBSP in adjacent nested quotation marks
-#    - absence of NBSP around en dash just inside quotation mark
-#    - as above, for spaced out elipsis
-#    (and any similar unsual typographic features)
-# 
-# TODO need to document NBSP specifically, because the distinction is technical and not obvious to the eye
-
-report.write("\nQuote spacing")
-report.write("\n              unexpected spaces: " + str(counters.spaced_q))
-report.write("\n                 missing spaces: " + str(counters.unspaced_q))
-report.write("\n")
-
-# TODO document as defaulting to open-quotes (with user free to search+replace all)
-report.write("\nStraight quote characters")
-report.write("\n         straight single quotes: " + str(counters.straight_q))
-report.write("\n         straight double quotes: " + str(counters.straight_q2))
-report.write("\n")
+		reader = threading.Thread(target=read_files, args=(args, options, budget, inputs))
+		writer = threading.Thread(target=write_files, args=(outputs, options, outfile, budget, write_errors))
+		for thread in (reader, writer):
+			thread.daemon = True
+			thread.start()
+		
+		read_error = None
+		try:
+			while not write_errors:
+				item = queue_get(inputs)
+				if item is None:
+					break
+				if isinstance(item, Exception):
+					# Finish writing the files before it first
+					read_error = item
+					break
+				
+				(filename, text, size, sidecar) = item
+				if options.sidecar:
+					(checked, sidecar) = check_with_sidecar(text, sidecar, options, counters)
+					outputs.put((filename, checked, size, sidecar))
+					continue
+				
+				checked = io.StringIO()
+				checker = Checker(checked, options, counters)
+				checker.run(io.StringIO(text))
+				if options.stats:
+					file_stats.append((filename, checker.stats))
+				outputs.put((filename, checked.getvalue(), size, None))
+		finally:
+			# Even if checking failed, write the files before it
+			outputs.put(None)
+			thread_join(writer)
+		if write_errors:
+			raise write_errors[0]
+		if read_error:
+			raise read_error
+
+	if not options.modify:
+		outfile.flush()
+
+	write_report(sys.stderr, counters, options)
+
+	if options.stats:
+		with open(options.stats, 'w') as f:
+			json.dump({
+				'files': [dict(stats.as_dict(), file=filename)
+				          for (filename, stats) in file_stats],
+				'counters': vars(counters),
+			}, f, indent=1, sort_keys=True)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
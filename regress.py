@@ -0,0 +1,464 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8
+
+# regress.py
+#
+# Regression tests for quotes.py.
+#
+# Runs quotes.py on each of the examples, in each of the ways it can be
+# run ("engines"), and checks the marked output and the counters against
+# the expected results in examples/expected/.  This includes running it
+# again with --resume.
+#
+# An example can start with a comment giving options for quotes.py:
+#
+#     <!-- regress.py: --style german -->
+#
+# With --stats, the statistics are checked as part of the report.
+#
+# Also runs every engine on randomly generated HTML, and on one large
+# generated document, and checks they all give the same results.
+#
+# With --reference, also runs another copy of quotes.py (e.g. the previous
+# version, from "git show HEAD:quotes.py") on all of these, and checks it
+# gives the same results.
+#
+# Timings for each engine are shown side by side.  The large document
+# shows the time taken by the checker itself; for the small files it is
+# mostly starting python.
+
+import sys
+import os
+import optparse
+import subprocess
+import tempfile
+import shutil
+import random
+import re
+import time
+import difflib
+import shlex
+import json
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+QUOTES = os.path.join(HERE, 'quotes.py')
+EXAMPLES = os.path.join(HERE, 'examples')
+EXPECTED = os.path.join(EXAMPLES, 'expected')
+
+opt = optparse.OptionParser(usage=
+"""%prog [options] [-- QUOTES_OPTIONS]
+
+Check quotes.py against the expected output for the examples.
+QUOTES_OPTIONS are passed to quotes.py; the expected output
+is only checked when there are none.""")
+
+opt.add_option('--update',
+	action="store_true", dest="update",
+	help="rewrite the expected output from the current quotes.py")
+
+opt.add_option('--reference', metavar="FILE",
+	dest="reference",
+	help="another version of quotes.py to compare with")
+
+opt.add_option('--random', metavar="N",
+	type="int", dest="random", default=20,
+	help="number of random documents, default %default")
+
+opt.add_option('--large', metavar="KB",
+	type="int", dest="large", default=256,
+	help="size of the large document, default %default KB (0 for none)")
+
+opt.add_option('--seed',
+	type="int", dest="seed", default=0,
+	help="seed for the random documents, default %default")
+
+opt.add_option('--python', metavar="PYTHON",
+	dest="python", default=sys.executable,
+	help="interpreter to run quotes.py, default %default")
+
+
+def example_files():
+	names = []
+	for (dirpath, dirnames, filenames) in os.walk(EXAMPLES):
+		if os.path.abspath(dirpath) == EXPECTED:
+			del dirnames[:]
+			continue
+		dirnames.sort()
+		for filename in sorted(filenames):
+			names.append(os.path.relpath(os.path.join(dirpath, filename), EXAMPLES))
+	return names
+
+EXAMPLE_OPTIONS = re.compile(br'^<!-- regress.py: (.*) -->')
+
+def example_options(path):
+	# Options for quotes.py given in the first line of the example
+	with open(path, 'rb') as f:
+		m = EXAMPLE_OPTIONS.match(f.readline())
+	if not m:
+		return []
+	return shlex.split(m.group(1).decode('UTF-8'))
+
+
+#
+# Random documents
+#
+# Words and punctuation, mixed with every type of
+# token the tokenizer understands.
+#
+WORDS = [u'a', u'cat', u'sat', u'on', u'the', u'mat', u'I', u'don’t',
+         u'it’s', u'’tis', u'dogs’', u'1984', u'l’homme']
+PUNCTUATION = [u'‘', u'’', u'“', u'”', u"'", u'"', u'(', u')',
+               u'«', u'»', u'„', u'‚', u'.', u',', u'?', u' ']
+INLINE = [u'<i>', u'</i>', u'<b>', u'</b>', u'<q>', u'</q>',
+          u'<br>', u'<br/>', u'<!-- ‘comment’ -->', u'<![CDATA[“x]]>',
+          u'&lsquo;', u'&rsquo;', u'&ldquo;', u'&rdquo;', u'&#8217;',
+          u'&#x201C;', u'&apos;', u'&amp;', u'&nbsp;']
+BLOCKS = [(u'<p>', u'</p>'), (u'<div>', u'</div>'), (u'<pre>', u'</pre>'),
+          (u'<li>', u'</li>'), (u'<p class="x">', u'</p>'),
+          (u'<script>', u'</script>')]
+
+def random_document(rng, size=0):
+	# Adds blocks until there are at least "size" characters
+	doc = [u'<?xml version="1.0"?>\n<html>\n<body>\n']
+	length = 0
+	blocks = rng.randint(1, 30)
+	while blocks > 0 or length < size:
+		blocks -= 1
+		(start, end) = rng.choice(BLOCKS)
+		block = [start]
+		for j in range(rng.randint(0, 40)):
+			r = rng.random()
+			if r < 0.5:
+				block.append(rng.choice(WORDS))
+			elif r < 0.8:
+				block.append(rng.choice(PUNCTUATION))
+			else:
+				block.append(rng.choice(INLINE))
+			block.append(rng.choice([u' ', u' ', u'', u'\n']))
+		block.append(end + u'\n')
+		doc.extend(block)
+		length += sum([len(text) for text in block])
+	doc.append(u'</body>\n</html>\n')
+	return u''.join(doc)
+
+
+#
+# Running quotes.py
+#
+# Each run gives the marked output, the report (counters),
+# and the elapsed time.
+#
+COUNTER = re.compile(br'^\s*(.*?):\s*(\d+)$')
+
+def parse_report(report):
+	# List of (label, count)
+	counts = []
+	for line in report.splitlines():
+		m = COUNTER.match(line)
+		if m:
+			counts.append((m.group(1), int(m.group(2))))
+	return counts
+
+def sum_reports(reports):
+	totals = parse_report(reports[0])
+	for report in reports[1:]:
+		counts = parse_report(report)
+		assert [label for (label, n) in counts] == [label for (label, n) in totals]
+		totals = [(label, n + m) for ((label, n), (_, m)) in zip(totals, counts)]
+	return totals
+
+def stats_report(path):
+	# The --stats file, as text to add to the report.
+	# Filenames are left out, as they vary between engines.
+	with open(path) as f:
+		stats = json.load(f)
+	for file_stats in stats['files']:
+		del file_stats['file']
+	return ('\nStatistics\n' + json.dumps(stats, indent=1, sort_keys=True,
+	                                          separators=(',', ': ')) +
+	        '\n').encode('ASCII')
+
+class Script(object):
+	"""A copy of quotes.py, and how to run it."""
+
+	def __init__(self, path, python, quotes_options):
+		self.path = path
+		self.python = python
+		self.quotes_options = quotes_options	# passed to every run
+
+	def supports(self, option):
+		# Older versions of quotes.py don't have every option
+		return option.encode('ASCII') in read_file(self.path)
+
+	def run(self, args, stdin=None, extra=[]):
+		# extra: options for the example
+		stats = None
+		if '--stats' in extra:
+			(fd, stats) = tempfile.mkstemp(prefix='quotes-stats-')
+			os.close(fd)
+			i = extra.index('--stats') + 1
+			extra = extra[:i] + [stats] + extra[i:]
+		try:
+			(out, err, elapsed) = self.run_command(extra + args, stdin)
+			if stats:
+				err += stats_report(stats)
+		finally:
+			if stats:
+				os.remove(stats)
+		return (out, err, elapsed)
+
+	def run_command(self, args, stdin=None):
+		cmd = [self.python, self.path] + self.quotes_options + args
+		start = time.time()
+		if stdin is None:
+			p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			(out, err) = p.communicate()
+		else:
+			with open(stdin, 'rb') as f:
+				p = subprocess.Popen(cmd, stdin=f, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+				(out, err) = p.communicate()
+		elapsed = time.time() - start
+		if p.returncode != 0:
+			raise RuntimeError(' '.join(cmd) + ' failed:\n' + err.decode('UTF-8', 'replace'))
+		return (out, err, elapsed)
+
+# Engines which run one file at a time, with the options for the example
+def engine_file(script, filename, extra):
+	return script.run([filename], extra=extra)
+
+def engine_stdin(script, filename, extra):
+	return script.run([], stdin=filename, extra=extra)
+
+def engine_resume(script, filename, extra):
+	# Check a copy with --sidecar, then put back the original text,
+	# as if every marker had been removed by hand, and --resume.
+	# Only the regions which had markers are checked again.
+	if not script.supports('--resume') or '--stats' in extra:
+		return None
+	tmpdir = tempfile.mkdtemp(prefix='quotes-resume-')
+	try:
+		copy = os.path.join(tmpdir, os.path.basename(filename))
+		shutil.copy(filename, copy)
+		script.run(['--modify', '--sidecar', copy], extra=extra)
+		shutil.copy(filename, copy)
+		(out, err, elapsed) = script.run(['--modify', '--resume', copy], extra=extra)
+		return (read_file(copy), err, elapsed)
+	finally:
+		shutil.rmtree(tmpdir)
+
+ENGINES = [
+	('file', engine_file),
+	('stdin', engine_stdin),
+	('resume', engine_resume),
+]
+
+# Engines which run all the files at once, with the background
+# reader and writer.  Output is concatenated, and the counters summed.
+# Examples with their own options are left out.
+def batch_default(script, filenames):
+	return script.run(filenames)
+
+def batch_unbuffered(script, filenames):
+	# A budget of one byte allows one file in memory at a time
+	if not script.supports('--buffer-size'):
+		return None
+	return script.run(['--buffer-size', '1'] + filenames)
+
+BATCH_ENGINES = [
+	('batch', batch_default),
+	('batch-1', batch_unbuffered),
+]
+
+
+#
+# Checking
+#
+class Results(object):
+	def __init__(self):
+		self.failures = 0
+		self.timings = {}	# (group, engine name) -> total seconds
+
+	def time(self, group, name, elapsed):
+		key = (group, name)
+		self.timings[key] = self.timings.get(key, 0.0) + elapsed
+
+	def fail(self, what, message=''):
+		self.failures += 1
+		sys.stdout.write('FAIL: ' + what + '\n' + message)
+
+	def compare(self, what, expected, actual):
+		if expected == actual:
+			return
+		self.fail(what)
+		expected = expected.decode('UTF-8', 'replace').splitlines(True)
+		actual = actual.decode('UTF-8', 'replace').splitlines(True)
+		for line in difflib.unified_diff(expected, actual, 'expected', 'actual'):
+			write_text(line)
+
+def write_text(text):
+	sys.stdout.write(text.encode('UTF-8') if str is bytes else text)
+
+def expected_path(name, ext):
+	return os.path.join(EXPECTED, name + ext)
+
+def read_file(path):
+	with open(path, 'rb') as f:
+		return f.read()
+
+def write_file(path, data):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		f.write(data)
+
+def run_engine(results, what, engine, *args):
+	# Returns the result of engine(*args), or None.
+	# If quotes.py failed, counts it as a failure.
+	try:
+		return engine(*args)
+	except RuntimeError as e:
+		results.fail(what)
+		write_text(e.args[0])
+		return None
+
+def check_engines(results, group, script, names, directory, expected=None):
+	# Run every engine on every file, and check the results
+	# are the same as expected(name), or else the first engine.
+	# Returns {name: (output, report)}.  Examples which need
+	# options the script doesn't have are skipped.
+	checked = {}
+	batch = []
+	for name in names:
+		filename = os.path.join(directory, name)
+		extra = example_options(filename)
+		if not all([script.supports(o) for o in extra if o.startswith('--')]):
+			continue
+		first = None
+		if expected:
+			first = expected(name)
+		ran = False
+		for (engine, engine_function) in ENGINES:
+			result = run_engine(results, name + ' (' + engine + ')',
+			                    engine_function, script, filename, extra)
+			if result is None:
+				continue
+			(out, err, elapsed) = result
+			results.time(group, engine, elapsed)
+			ran = True
+			if first is None:
+				first = (out, err)
+			results.compare(name + ' (' + engine + ' output)', first[0], out)
+			results.compare(name + ' (' + engine + ' report)', first[1], err)
+		if ran:
+			checked[name] = first
+			if not extra:
+				# (a file which quotes.py fails on would stop the batch)
+				batch.append(name)
+
+	if not batch:
+		# (with no files, quotes.py would read stdin)
+		return checked
+	filenames = [os.path.join(directory, name) for name in batch]
+	for (engine, engine_function) in BATCH_ENGINES:
+		result = run_engine(results, 'all files (' + engine + ')',
+		                    engine_function, script, filenames)
+		if result is None:
+			continue
+		(out, err, elapsed) = result
+		results.time(group, engine, elapsed)
+		results.compare('all files (' + engine + ' output)',
+		                b''.join([checked[name][0] for name in batch]), out)
+		if sum_reports([checked[name][1] for name in batch]) != parse_report(err):
+			results.fail('all files (' + engine + ' counters)')
+	return checked
+
+def show_timings(groups, columns):
+	# columns: list of (heading, Results)
+	engines = [name for (name, _) in ENGINES + BATCH_ENGINES]
+	for group in groups:
+		sys.stdout.write('\n%-20s' % ('seconds, ' + group))
+		for (heading, _) in columns:
+			sys.stdout.write('%12s' % heading)
+		sys.stdout.write('\n')
+		for engine in engines:
+			sys.stdout.write('%-20s' % engine)
+			for (_, results) in columns:
+				sys.stdout.write('%12.3f' % results.timings.get((group, engine), 0.0))
+			sys.stdout.write('\n')
+
+def main(argv=None):
+	(options, quotes_options) = opt.parse_args(argv)
+	names = example_files()
+	current = Results()
+	script = Script(QUOTES, options.python, quotes_options)
+
+	if options.update:
+		if quotes_options:
+			opt.error("--update can't be used with QUOTES_OPTIONS")
+		for name in names:
+			filename = os.path.join(EXAMPLES, name)
+			(out, err, elapsed) = engine_file(script, filename, example_options(filename))
+			write_file(expected_path(name, '.out'), out)
+			write_file(expected_path(name, '.report'), err)
+		sys.stdout.write('Updated %d examples\n' % len(names))
+		return 0
+
+	if quotes_options:
+		expected = None
+	else:
+		def expected(name):
+			return (read_file(expected_path(name, '.out')),
+			        read_file(expected_path(name, '.report')))
+
+	# Generated documents, which are checked by comparing the engines
+	tmpdir = tempfile.mkdtemp(prefix='quotes-regress-')
+	try:
+		rng = random.Random(options.seed)
+		random_names = []
+		for i in range(options.random):
+			name = 'random%03d.html' % i
+			write_file(os.path.join(tmpdir, name),
+			           random_document(rng).encode('UTF-8'))
+			random_names.append(name)
+		large_names = []
+		if options.large:
+			name = 'large.html'
+			write_file(os.path.join(tmpdir, name),
+			           random_document(rng, options.large * 1024).encode('UTF-8'))
+			large_names.append(name)
+
+		groups = [('examples', names, EXAMPLES, expected),
+		          ('random', random_names, tmpdir, None),
+		          ('large', large_names, tmpdir, None)]
+		results = {}
+		for (group, group_names, directory, group_expected) in groups:
+			results[group] = check_engines(current, group, script,
+			                               group_names, directory, group_expected)
+		columns = [('current', current)]
+
+		if options.reference:
+			# The reference must give the same results as the current version
+			reference = Results()
+			reference_script = Script(options.reference, options.python, quotes_options)
+			for (group, group_names, directory, _) in groups:
+				check_engines(reference, group, reference_script,
+				              group_names, directory, results[group].get)
+			columns.append(('reference', reference))
+	finally:
+		shutil.rmtree(tmpdir)
+
+	show_timings([group for (group, group_names, _, _) in groups if group_names],
+	             columns)
+
+	failures = current.failures
+	if options.reference:
+		failures += reference.failures
+	if failures:
+		sys.stdout.write('\n%d failures\n' % failures)
+		return 1
+	sys.stdout.write('\nOK\n')
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())